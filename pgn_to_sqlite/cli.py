@@ -1,7 +1,15 @@
+import functools
+import io
+import multiprocessing
+import os
 import re
+import shutil
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional
+from urllib.parse import urlparse
 
 import berserk
 import click
@@ -15,6 +23,34 @@ from rich.progress import (
     TimeRemainingColumn,
 )
 
+# The columns of the games table, in the order they are exported.
+EXPORT_DB_COLUMNS = (
+    "id",
+    "event",
+    "site",
+    "date",
+    "round",
+    "white",
+    "black",
+    "result",
+    "eco",
+    "white_elo",
+    "black_elo",
+    "variant",
+    "time_control",
+    "termination",
+    "moves",
+)
+
+# Maps the `--partition-by` choices to the exported column they partition on.
+EXPORT_PARTITION_COLUMNS = {"year": "year", "site": "site_name"}
+
+# The subfolders of the export destination that each table is written to.
+EXPORT_TABLE_FOLDERS = ("games", "positions")
+
+# Only games of these variants can be replayed from the standard starting position.
+INDEXABLE_VARIANTS = ("", "Standard")
+
 
 def convert_to_snake_case(value: str) -> str:
     """Convert any camel case attribute name to snake case
@@ -105,6 +141,444 @@ def save_game_to_db(connection, pgn: dict) -> None:
     )
 
 
+def _parse_int(value) -> Optional[int]:
+    """Converts a database value to an integer, or None if it isn't numeric
+
+    Args:
+        value: The value read from the database
+
+    Returns:
+        The integer value, or None.
+    """
+    if isinstance(value, int):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_pgn_date(value: Optional[str]) -> Optional[date]:
+    """Converts a PGN date string (YYYY.MM.DD) to a date object
+
+    PGN dates may contain unknown parts (e.g. `2021.??.??`). Those can't be
+    represented as a date, so None is returned instead.
+
+    Args:
+        value: A PGN date string
+
+    Returns:
+        The date, or None.
+    """
+    try:
+        year, month, day = (int(part) for part in value.split("."))
+        return date(year, month, day)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def _site_name(value: Optional[str]) -> str:
+    """Reduces a PGN site tag to a name suitable for partitioning
+
+    Lichess stores the URL of each game as the site, which would create a
+    partition per game. The host name is used instead, e.g.
+    `https://lichess.org/u0SmP3rV` becomes `lichess.org`.
+
+    Args:
+        value: A PGN site tag
+
+    Returns:
+        The site name.
+    """
+    if not value:
+        return "unknown"
+    host = urlparse(value).netloc
+    return (host or value).lower().removeprefix("www.")
+
+
+def build_export_schema():
+    """Builds the typed Arrow schema used when exporting the games table
+
+    Returns:
+        A pyarrow Schema.
+    """
+    import pyarrow as pa
+
+    types = {
+        "id": pa.int64(),
+        "date": pa.date32(),
+        "white_elo": pa.int32(),
+        "black_elo": pa.int32(),
+    }
+    fields = [
+        pa.field(name, types.get(name, pa.string())) for name in EXPORT_DB_COLUMNS
+    ]
+    fields.append(pa.field("year", pa.int16()))
+    fields.append(pa.field("site_name", pa.string()))
+
+    return pa.schema(fields)
+
+
+def iter_game_batches(connection, schema, chunk_size: int) -> Iterator:
+    """Reads the games table in chunks and yields them as Arrow record batches
+
+    Only `chunk_size` rows are held in memory at a time, so databases larger
+    than the available RAM can be exported.
+
+    Args:
+        connection: A database connection object
+        schema: The pyarrow schema of the yielded batches
+        chunk_size: The number of rows read from the database per batch
+
+    Yields:
+        A pyarrow RecordBatch.
+    """
+    import pyarrow as pa
+
+    cursor = connection.cursor()
+    cursor.execute(f"SELECT {', '.join(EXPORT_DB_COLUMNS)} FROM games ORDER BY id;")
+
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+
+        columns = {name: [] for name in schema.names}
+        for row in rows:
+            record = dict(zip(EXPORT_DB_COLUMNS, row))
+
+            for name, value in record.items():
+                if name in ("id", "white_elo", "black_elo"):
+                    value = _parse_int(value)
+                elif name == "date":
+                    value = _parse_pgn_date(value)
+                columns[name].append(value)
+
+            columns["year"].append(_parse_int((record["date"] or "")[:4]))
+            columns["site_name"].append(_site_name(record["site"]))
+
+        yield pa.RecordBatch.from_pydict(columns, schema=schema)
+
+
+def build_positions_export_schema():
+    """Builds the typed Arrow schema used when exporting the positions table
+
+    Returns:
+        A pyarrow Schema.
+    """
+    import pyarrow as pa
+
+    return pa.schema(
+        [
+            pa.field("game_id", pa.int64()),
+            pa.field("ply", pa.int32()),
+            pa.field("hash", pa.int64()),
+        ]
+    )
+
+
+def iter_position_batches(connection, schema, chunk_size: int) -> Iterator:
+    """Reads the positions table in chunks and yields them as Arrow record batches
+
+    Args:
+        connection: A database connection object
+        schema: The pyarrow schema of the yielded batches
+        chunk_size: The number of rows read from the database per batch
+
+    Yields:
+        A pyarrow RecordBatch.
+    """
+    import pyarrow as pa
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT game_id, ply, hash FROM positions ORDER BY game_id, ply;")
+
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+
+        yield pa.RecordBatch.from_pydict(
+            dict(zip(schema.names, zip(*rows))), schema=schema
+        )
+
+
+def _is_export_file(path: Path) -> bool:
+    """Checks whether a path is one of the files or folders an export writes
+
+    Args:
+        path: A path inside an export folder
+
+    Returns:
+        True if the path was written by an export.
+    """
+    if path.is_dir():
+        return re.fullmatch(r"(year|site_name)=.*", path.name) is not None
+    return re.fullmatch(r"part-\d+\.(parquet|arrow)", path.name) is not None
+
+
+def remove_exported_files(folder: Path) -> None:
+    """Removes the files written by an earlier export from a folder
+
+    Only partition folders and data files are removed, from the folder and
+    from its `games` and `positions` subfolders. Anything else is left alone.
+
+    Args:
+        folder: The destination folder of an earlier export
+
+    Returns:
+        Nothing.
+    """
+    for subfolder in (folder, *EXPORT_TABLE_FOLDERS):
+        path = folder / subfolder
+        if not path.is_dir():
+            continue
+
+        for entry in path.iterdir():
+            if _is_export_file(entry):
+                if entry.is_dir():
+                    shutil.rmtree(entry)
+                else:
+                    entry.unlink()
+
+        if path != folder and not any(path.iterdir()):
+            path.rmdir()
+
+
+def require_chess() -> None:
+    """Checks that the optional python-chess dependency is installed
+
+    Returns:
+        Nothing.
+    """
+    try:
+        import chess  # noqa: F401
+    except ImportError:
+        print(
+            "ERROR:   Indexing positions requires python-chess. "
+            "Install it with `pip install pgn_to_sqlite[positions]`."
+        )
+        raise click.Abort()
+
+
+def _to_signed_64(value: int) -> int:
+    """Converts an unsigned 64-bit integer to the signed range SQLite can store
+
+    Args:
+        value: An unsigned 64-bit integer
+
+    Returns:
+        The same 64 bits as a signed integer.
+    """
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def hash_position(fen: str) -> int:
+    """Calculates the position hash of a FEN string
+
+    The move counters of the FEN are not part of the hash, so the same position
+    is found regardless of how many moves it took to reach it.
+
+    Args:
+        fen: A FEN string
+
+    Returns:
+        The signed 64-bit Zobrist hash of the position.
+
+    Raises:
+        ValueError: If the FEN string is invalid.
+    """
+    import chess
+    import chess.polyglot
+
+    return _to_signed_64(chess.polyglot.zobrist_hash(chess.Board(fen)))
+
+
+@functools.cache
+def _quiet_game_builder() -> type:
+    """Builds a python-chess game builder that doesn't log parsing errors
+
+    The class is built on first use, as python-chess is an optional dependency.
+
+    Returns:
+        A chess.pgn.GameBuilder subclass.
+    """
+    import chess.pgn
+
+    class QuietGameBuilder(chess.pgn.GameBuilder):
+        def handle_error(self, error: Exception) -> None:
+            # Collect the error without python-chess logging it to stderr.
+            self.game.errors.append(error)
+
+    return QuietGameBuilder
+
+
+def replay_game_positions(game: tuple) -> list:
+    """Replays the moves of a game and hashes the position after every ply
+
+    This is run in worker processes, so it must remain a module level function.
+    Games with illegal or unparsable moves (e.g. games started from a custom
+    position) return no positions, as a partial replay would give false matches.
+
+    Args:
+        game: A tuple of the game id and its move notation
+
+    Returns:
+        A list of (game_id, ply, hash) tuples. Ply 0 is the starting position.
+    """
+    import chess.pgn
+    import chess.polyglot
+
+    game_id, moves = game
+    parsed = chess.pgn.read_game(
+        io.StringIO(moves or ""), Visitor=_quiet_game_builder()
+    )
+    if parsed is None or parsed.errors:
+        return []
+
+    board = parsed.board()
+    positions = [(game_id, 0, _to_signed_64(chess.polyglot.zobrist_hash(board)))]
+
+    for ply, move in enumerate(parsed.mainline_moves(), start=1):
+        board.push(move)
+        positions.append(
+            (game_id, ply, _to_signed_64(chess.polyglot.zobrist_hash(board)))
+        )
+
+    return positions
+
+
+def create_positions_tables(connection) -> None:
+    """Creates the tables used to look up games by position
+
+    The positions table holds the hash of every position of every game. The
+    indexed_games table records which games have been replayed, including
+    those that had no positions to store, so they aren't replayed again.
+
+    Args:
+        connection: A database connection object
+
+    Returns:
+        Nothing.
+    """
+    execute_db_query(
+        connection,
+        """CREATE TABLE IF NOT EXISTS positions (
+            game_id INTEGER NOT NULL REFERENCES games(id),
+            ply INTEGER NOT NULL,
+            hash INTEGER NOT NULL,
+            PRIMARY KEY (game_id, ply)
+        ) WITHOUT ROWID;
+        """,
+    )
+    execute_db_query(
+        connection,
+        "CREATE INDEX IF NOT EXISTS positions_hash ON positions(hash);",
+    )
+    execute_db_query(
+        connection,
+        """CREATE TABLE IF NOT EXISTS indexed_games (
+            game_id INTEGER PRIMARY KEY REFERENCES games(id)
+        );
+        """,
+    )
+
+
+def _save_game_positions(connection, games: list, results) -> None:
+    """Saves the replayed positions of a chunk of games in one transaction
+
+    Args:
+        connection: A database connection object
+        games: The (game_id, moves) tuples that were replayed
+        results: The replay_game_positions results for those games
+
+    Returns:
+        Nothing.
+    """
+    connection.executemany(
+        "INSERT INTO positions(game_id, ply, hash) VALUES (?, ?, ?);",
+        (position for positions in results for position in positions),
+    )
+    connection.executemany(
+        "INSERT INTO indexed_games(game_id) VALUES (?);",
+        ((game_id,) for game_id, _ in games),
+    )
+    connection.commit()
+
+
+def index_game_positions(
+    connection, workers: Optional[int] = None, chunk_size: int = 1000
+) -> None:
+    """Replays all games that aren't indexed yet and saves their position hashes
+
+    Games are read from the database in chunks and replayed across worker
+    processes. While the workers replay one chunk, the positions of the
+    previous chunk are bulk inserted into the positions table.
+
+    Args:
+        connection: A database connection object
+        workers: The number of worker processes. Defaults to the CPU count.
+        chunk_size: The number of games replayed per database transaction
+
+    Returns:
+        Nothing.
+    """
+    create_positions_tables(connection)
+
+    workers = workers or os.cpu_count() or 1
+    unindexed_query = f"""FROM games
+        WHERE variant IN ({", ".join("?" * len(INDEXABLE_VARIANTS))})
+        AND id NOT IN (SELECT game_id FROM indexed_games)"""
+
+    total = connection.execute(
+        f"SELECT COUNT(*) {unindexed_query};", INDEXABLE_VARIANTS
+    ).fetchone()[0]
+
+    with (
+        # The pool starts its workers while the progress display's thread is
+        # running, so they're spawned rather than forked from this process.
+        ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor,
+        Progress(
+            SpinnerColumn(),
+            TextColumn("[progress.description]{task.description}"),
+            BarColumn(),
+            TaskProgressColumn(),
+            TimeRemainingColumn(),
+        ) as progress,
+    ):
+        task = progress.add_task("Indexing positions...", total=total)
+        last_id = 0
+        pending = None
+
+        while True:
+            games = connection.execute(
+                f"SELECT id, moves {unindexed_query} AND id > ? ORDER BY id LIMIT ?;",
+                (*INDEXABLE_VARIANTS, last_id, chunk_size),
+            ).fetchall()
+
+            # Submit the next chunk before saving the previous one, so the
+            # workers aren't idle while the positions are inserted.
+            if games:
+                last_id = games[-1][0]
+                results = executor.map(
+                    replay_game_positions,
+                    games,
+                    chunksize=max(1, len(games) // (workers * 4)),
+                )
+
+            if pending:
+                _save_game_positions(connection, *pending)
+                progress.update(task, advance=len(pending[0]))
+
+            if not games:
+                break
+            pending = (games, results)
+
+    print(f"INFO:    Indexed positions of {total} games")
+
+
 def fetch_chess_dotcom_games(user: str) -> list:
     """Uses the chess.com API to fetch the requested users games.
 
@@ -367,14 +841,28 @@ def cli(ctx, user, output):
 
 @cli.command()
 @click.argument("site")
+@click.option(
+    "--index-positions",
+    is_flag=True,
+    help="Index the position after every move for `find-position`.",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Processes used to index positions. Defaults to the CPU count.",
+)
 @click.pass_context
-def fetch(ctx, site):
+def fetch(ctx, site, index_positions, workers):
     """Fetch all games from the requested site."""
 
     user = ctx.obj["USER"]
     output = ctx.obj["OUTPUT"]
     db_conn = ctx.obj["DB_CONN"]
 
+    if index_positions:
+        require_chess()
+
     if site == "chess":
         print(f"INFO:    Fetching games for {user} from chess.com")
         games = fetch_chess_dotcom_games(user)
@@ -416,18 +904,35 @@ def fetch(ctx, site):
             f"'{site}' is not a valid argument. Check --help for valid inputs"
         )
 
+    if index_positions:
+        index_game_positions(db_conn, workers)
+
     print(f"INFO:    Games saved to {output}")
 
 
 @cli.command()
 @click.argument("folder")
+@click.option(
+    "--index-positions",
+    is_flag=True,
+    help="Index the position after every move for `find-position`.",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Processes used to index positions. Defaults to the CPU count.",
+)
 @click.pass_context
-def save(ctx, folder):
+def save(ctx, folder, index_positions, workers):
     """Fetch all pgn file from the given folder."""
 
     output = ctx.obj["OUTPUT"]
     db_conn = ctx.obj["DB_CONN"]
 
+    if index_positions:
+        require_chess()
+
     folder_path = Path(folder)
 
     print(f"INFO:    Fetching games from folder: {folder_path}")
@@ -450,8 +955,206 @@ def save(ctx, folder):
                 save_game_to_db(db_conn, pgn_dict)
             progress.update(task, advance=1)
 
+    if index_positions:
+        index_game_positions(db_conn, workers)
+
     print(f"INFO:    Games saved to {output}")
 
 
+@cli.command()
+@click.argument(
+    "destination",
+    type=click.Path(file_okay=False, dir_okay=True, allow_dash=False),
+)
+@click.option(
+    "-f",
+    "--format",
+    "file_format",
+    type=click.Choice(["parquet", "arrow"]),
+    default="parquet",
+    show_default=True,
+    help="The columnar file format to export to.",
+)
+@click.option(
+    "-p",
+    "--partition-by",
+    type=click.Choice(list(EXPORT_PARTITION_COLUMNS)),
+    multiple=True,
+    default=("year", "site"),
+    show_default=True,
+    help="Partition the exported files by these columns. Can be repeated.",
+)
+@click.option(
+    "--chunk-size",
+    type=click.IntRange(min=1),
+    default=50_000,
+    show_default=True,
+    help="The number of games read from the database at a time.",
+)
+@click.option(
+    "--overwrite",
+    is_flag=True,
+    help="Delete the contents of the destination folder before exporting.",
+)
+@click.pass_context
+def export(ctx, destination, file_format, partition_by, chunk_size, overwrite):
+    """Export the games and positions tables to Parquet or Arrow files."""
+
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+    except ImportError:
+        print(
+            "ERROR:   Exporting requires pyarrow. "
+            "Install it with `pip install pgn_to_sqlite[export]`."
+        )
+        raise click.Abort()
+
+    output = ctx.obj["OUTPUT"]
+    db_conn = ctx.obj["DB_CONN"]
+
+    destination_path = Path(destination).resolve()
+    if destination_path.exists() and any(destination_path.iterdir()):
+        if not overwrite:
+            print(
+                f"ERROR:   The folder '{destination}' is not empty. "
+                "Use --overwrite to replace its contents."
+            )
+            raise click.Abort()
+
+        protected = (Path(output).resolve(), Path.cwd().resolve())
+        if any(path.is_relative_to(destination_path) for path in protected):
+            print(
+                f"ERROR:   Refusing to overwrite '{destination}' as it contains "
+                "the database or the current folder."
+            )
+            raise click.Abort()
+
+        try:
+            remove_exported_files(destination_path)
+        except OSError as e:
+            print(f"ERROR:   Unable to remove the earlier export: {e}")
+            raise click.Abort()
+
+    total = db_conn.execute("SELECT COUNT(*) FROM games;").fetchone()[0]
+    if total == 0:
+        print(f"INFO:    No games to export from {output}")
+        return
+
+    has_positions = db_conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'positions';"
+    ).fetchone()
+    total_positions = (
+        db_conn.execute("SELECT COUNT(*) FROM positions;").fetchone()[0]
+        if has_positions
+        else 0
+    )
+
+    print(f"INFO:    Exporting {total} games from {output} to {destination}")
+
+    # pyarrow pulls the batches from one of its own threads, so the tables are
+    # read through a separate connection that isn't bound to this thread.
+    read_conn = sqlite3.connect(output, check_same_thread=False)
+
+    try:
+        with Progress(
+            SpinnerColumn(),
+            TextColumn("[progress.description]{task.description}"),
+            BarColumn(),
+            TaskProgressColumn(),
+            TimeRemainingColumn(),
+        ) as progress:
+            tables = [
+                (
+                    "games",
+                    "Exporting games...",
+                    total,
+                    build_export_schema(),
+                    iter_game_batches,
+                    [EXPORT_PARTITION_COLUMNS[name] for name in partition_by],
+                )
+            ]
+            if total_positions:
+                tables.append(
+                    (
+                        "positions",
+                        "Exporting positions...",
+                        total_positions,
+                        build_positions_export_schema(),
+                        iter_position_batches,
+                        [],
+                    )
+                )
+
+            for folder, description, rows, schema, iter_batches, partitions in tables:
+                task = progress.add_task(description, total=rows)
+
+                def batches():
+                    for batch in iter_batches(read_conn, schema, chunk_size):
+                        yield batch
+                        progress.update(task, advance=batch.num_rows)
+
+                ds.write_dataset(
+                    batches(),
+                    destination_path / folder,
+                    schema=schema,
+                    format="parquet" if file_format == "parquet" else "ipc",
+                    partitioning=partitions or None,
+                    partitioning_flavor="hive",
+                    # A batch can't span more partitions than it has rows, e.g.
+                    # when every game of an over-the-board collection has its
+                    # own venue as the site.
+                    max_partitions=max(chunk_size, 1024),
+                    existing_data_behavior="overwrite_or_ignore",
+                )
+    except pa.ArrowInvalid as e:
+        print(f"ERROR:   Unable to export games: {e}")
+        raise click.Abort()
+    finally:
+        read_conn.close()
+
+    print(f"INFO:    Games exported to {destination}")
+
+
+@cli.command("find-position")
+@click.option("--fen", required=True, help="The FEN of the position to find.")
+@click.pass_context
+def find_position(ctx, fen):
+    """Find all games that reached the given position."""
+
+    require_chess()
+
+    db_conn = ctx.obj["DB_CONN"]
+
+    try:
+        position_hash = hash_position(fen)
+    except ValueError as e:
+        print(f"ERROR:   Invalid FEN '{fen}': {e}")
+        raise click.Abort()
+
+    positions_table = db_conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'positions';"
+    ).fetchone()
+    if positions_table is None:
+        print(
+            "ERROR:   No positions indexed. "
+            "Use `save` or `fetch` with --index-positions first."
+        )
+        raise click.Abort()
+
+    games = db_conn.execute(
+        """SELECT DISTINCT games.id, games.date, games.white, games.black,
+        games.result, games.site
+        FROM positions JOIN games ON games.id = positions.game_id
+        WHERE positions.hash = ?
+        ORDER BY games.id;""",
+        (position_hash,),
+    ).fetchall()
+
+    print(f"INFO:    Found {len(games)} games with this position")
+    for game_id, game_date, white, black, result, site in games:
+        print(f"{game_id}\t{game_date}\t{white} vs {black}\t{result}\t{site}")
+
+
 if __name__ == "__main__":
     cli()
@@ -14,6 +14,7 @@ from pgn_to_sqlite.cli import (
     convert_to_snake_case,
     fetch_chess_dotcom_games,
     fetch_lichess_org_games,
+    replay_game_positions,
 )
 
 
@@ -237,3 +238,383 @@ def test_save_command_creates_database_with_games():
 
         # We have 2 PGN files in the test directory
         assert count == 2
+
+
+def test_export_command_writes_partitioned_parquet():
+    """Test that export writes typed, partitioned parquet files for all games"""
+    ds = pytest.importorskip("pyarrow.dataset")
+    runner = CliRunner()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test_games.db")
+        export_path = os.path.join(tmpdir, "export")
+        result = runner.invoke(cli, ["-o", db_path, "save", "tests/game_files/"])
+        assert result.exit_code == 0
+
+        result = runner.invoke(
+            cli, ["-o", db_path, "export", export_path, "--chunk-size", "1"]
+        )
+        assert result.exit_code == 0
+
+        dataset = ds.dataset(
+            os.path.join(export_path, "games"), format="parquet", partitioning="hive"
+        )
+        table = dataset.to_table()
+
+        assert table.num_rows == 2
+        assert str(table.schema.field("white_elo").type) == "int32"
+        assert os.path.isdir(
+            os.path.join(export_path, "games", "year=2021", "site_name=lichess.org")
+        )
+
+
+def test_export_command_with_many_sites():
+    """Test that export handles more sites than pyarrow's default partition limit"""
+    ds = pytest.importorskip("pyarrow.dataset")
+    runner = CliRunner()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test_games.db")
+        export_path = os.path.join(tmpdir, "export")
+        result = runner.invoke(cli, ["-o", db_path, "save", "tests/game_files/"])
+        assert result.exit_code == 0
+
+        # Over-the-board games use their venue as the site
+        conn = sqlite3.connect(db_path)
+        conn.executemany(
+            "INSERT INTO games(site, date, moves) VALUES (?, ?, ?);",
+            [(f"Venue {i} ENG", "2021.01.01", "1. e4 e5") for i in range(1500)],
+        )
+        conn.commit()
+        conn.close()
+
+        result = runner.invoke(cli, ["-o", db_path, "export", export_path])
+        assert result.exit_code == 0
+
+        table = ds.dataset(
+            os.path.join(export_path, "games"), format="parquet", partitioning="hive"
+        )
+        assert table.count_rows() == 1502
+
+
+def test_export_command_into_non_empty_folder():
+    """Test that export only replaces an existing export when asked to"""
+    ds = pytest.importorskip("pyarrow.dataset")
+    runner = CliRunner()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test_games.db")
+        export_path = os.path.join(tmpdir, "export")
+        result = runner.invoke(cli, ["-o", db_path, "save", "tests/game_files/"])
+        assert result.exit_code == 0
+
+        result = runner.invoke(cli, ["-o", db_path, "export", export_path])
+        assert result.exit_code == 0
+
+        result = runner.invoke(
+            cli, ["-o", db_path, "export", export_path, "-p", "year"]
+        )
+        assert result.exit_code == 1
+
+        result = runner.invoke(
+            cli, ["-o", db_path, "export", export_path, "-p", "year", "--overwrite"]
+        )
+        assert result.exit_code == 0
+
+        dataset = ds.dataset(
+            os.path.join(export_path, "games"), format="parquet", partitioning="hive"
+        )
+        assert dataset.count_rows() == 2
+        assert not os.path.exists(
+            os.path.join(export_path, "games", "year=2021", "site_name=lichess.org")
+        )
+
+
+def test_export_command_arrow_error():
+    """Test that pyarrow errors during export are properly handled"""
+    pa = pytest.importorskip("pyarrow")
+    runner = CliRunner()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test_games.db")
+        export_path = os.path.join(tmpdir, "export")
+        result = runner.invoke(cli, ["-o", db_path, "save", "tests/game_files/"])
+        assert result.exit_code == 0
+
+        with patch("pyarrow.dataset.write_dataset") as mock_write:
+            mock_write.side_effect = pa.ArrowInvalid("Too many partitions")
+            result = runner.invoke(cli, ["-o", db_path, "export", export_path])
+
+        assert result.exit_code == 1
+        assert "ERROR:   Unable to export games" in result.output
+
+
+def test_export_command_overwrite_keeps_other_files():
+    """Test that --overwrite only removes files written by an earlier export"""
+    ds = pytest.importorskip("pyarrow.dataset")
+    runner = CliRunner()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test_games.db")
+        export_path = os.path.join(tmpdir, "export")
+        notes_path = os.path.join(export_path, "notes.txt")
+        result = runner.invoke(cli, ["-o", db_path, "save", "tests/game_files/"])
+        assert result.exit_code == 0
+
+        result = runner.invoke(cli, ["-o", db_path, "export", export_path])
+        assert result.exit_code == 0
+        with open(notes_path, "w") as f:
+            f.write("Not part of the export")
+
+        result = runner.invoke(
+            cli, ["-o", db_path, "export", export_path, "-p", "year", "--overwrite"]
+        )
+        assert result.exit_code == 0
+        assert os.path.isfile(notes_path)
+
+        dataset = ds.dataset(
+            os.path.join(export_path, "games"), format="parquet", partitioning="hive"
+        )
+        assert dataset.count_rows() == 2
+
+
+def test_export_command_overwrite_refuses_database_folder():
+    """Test that --overwrite never touches the folder holding the database"""
+    pytest.importorskip("pyarrow")
+    runner = CliRunner()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test_games.db")
+        notes_path = os.path.join(tmpdir, "notes.txt")
+        result = runner.invoke(cli, ["-o", db_path, "save", "tests/game_files/"])
+        assert result.exit_code == 0
+        with open(notes_path, "w") as f:
+            f.write("Not part of the export")
+
+        result = runner.invoke(cli, ["-o", db_path, "export", tmpdir, "--overwrite"])
+        assert result.exit_code == 1
+        assert "Refusing to overwrite" in result.output
+        assert os.path.isfile(db_path)
+        assert os.path.isfile(notes_path)
+
+
+def test_export_command_overwrite_refuses_current_folder(monkeypatch):
+    """Test that --overwrite never touches the current folder"""
+    pytest.importorskip("pyarrow")
+    runner = CliRunner()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test_games.db")
+        work_path = os.path.join(tmpdir, "work")
+        notes_path = os.path.join(work_path, "notes.txt")
+        result = runner.invoke(cli, ["-o", db_path, "save", "tests/game_files/"])
+        assert result.exit_code == 0
+
+        os.mkdir(work_path)
+        with open(notes_path, "w") as f:
+            f.write("Not part of the export")
+        monkeypatch.chdir(work_path)
+
+        result = runner.invoke(cli, ["-o", db_path, "export", ".", "--overwrite"])
+        assert result.exit_code == 1
+        assert os.path.isfile(notes_path)
+
+
+def test_export_command_empty_database():
+    """Test that exporting an empty database reports there is nothing to export"""
+    pytest.importorskip("pyarrow")
+    runner = CliRunner()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test_games.db")
+        export_path = os.path.join(tmpdir, "export")
+
+        result = runner.invoke(cli, ["-o", db_path, "export", export_path])
+        assert result.exit_code == 0
+        assert "No games to export" in result.output
+        assert "Games exported" not in result.output
+
+
+def test_export_command_with_positions():
+    """Test that indexed positions are exported to their own typed folder"""
+    ds = pytest.importorskip("pyarrow.dataset")
+    pytest.importorskip("chess")
+    runner = CliRunner()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test_games.db")
+        export_path = os.path.join(tmpdir, "export")
+        result = runner.invoke(
+            cli,
+            ["-o", db_path, "save", "tests/game_files/", "--index-positions"],
+        )
+        assert result.exit_code == 0
+
+        result = runner.invoke(cli, ["-o", db_path, "export", export_path])
+        assert result.exit_code == 0
+
+        conn = sqlite3.connect(db_path)
+        count = conn.execute("SELECT COUNT(*) FROM positions").fetchone()[0]
+        conn.close()
+
+        table = ds.dataset(
+            os.path.join(export_path, "positions"), format="parquet"
+        ).to_table()
+        assert table.num_rows == count
+        assert str(table.schema.field("ply").type) == "int32"
+        assert str(table.schema.field("hash").type) == "int64"
+
+
+def test_find_position_after_indexing_positions():
+    """Test that indexed positions can be looked up by FEN"""
+    pytest.importorskip("chess")
+    runner = CliRunner()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test_games.db")
+        result = runner.invoke(
+            cli,
+            ["-o", db_path, "save", "tests/game_files/", "--index-positions"],
+        )
+        assert result.exit_code == 0
+
+        # The position after 1. e4 c5 2. Nf3 Nc6 from the lichess game
+        result = runner.invoke(
+            cli,
+            [
+                "-o",
+                db_path,
+                "find-position",
+                "--fen",
+                "r1bqkbnr/pp1ppppp/2n5/2p5/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3",
+            ],
+        )
+        assert result.exit_code == 0
+        assert "Found 1 games" in result.output
+        assert "philcorn vs endlesstrax" in result.output
+
+
+def test_find_position_invalid_fen():
+    """Test that an invalid FEN aborts the find-position command"""
+    pytest.importorskip("chess")
+    runner = CliRunner()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test_games.db")
+        result = runner.invoke(
+            cli, ["-o", db_path, "find-position", "--fen", "not a fen"]
+        )
+        assert result.exit_code == 1
+
+
+def test_find_position_without_indexed_positions():
+    """Test that find-position aborts when no positions have been indexed"""
+    pytest.importorskip("chess")
+    runner = CliRunner()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test_games.db")
+        result = runner.invoke(
+            cli,
+            [
+                "-o",
+                db_path,
+                "find-position",
+                "--fen",
+                "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+            ],
+        )
+        assert result.exit_code == 1
+        assert "No positions indexed" in result.output
+
+
+def test_index_positions_skips_indexed_games():
+    """Test that games are only replayed the first time positions are indexed"""
+    pytest.importorskip("chess")
+    runner = CliRunner()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test_games.db")
+        empty_folder = os.path.join(tmpdir, "empty")
+        os.mkdir(empty_folder)
+
+        result = runner.invoke(cli, ["-o", db_path, "save", "tests/game_files/"])
+        assert result.exit_code == 0
+
+        # A game without moves has no positions to store
+        conn = sqlite3.connect(db_path)
+        conn.execute("INSERT INTO games(variant, moves) VALUES ('Standard', '');")
+        conn.commit()
+
+        result = runner.invoke(
+            cli, ["-o", db_path, "save", empty_folder, "--index-positions"]
+        )
+        assert result.exit_code == 0
+        assert "Indexed positions of 3 games" in result.output
+        count = conn.execute("SELECT COUNT(*) FROM positions").fetchone()[0]
+
+        result = runner.invoke(
+            cli, ["-o", db_path, "save", empty_folder, "--index-positions"]
+        )
+        assert result.exit_code == 0
+        assert "Indexed positions of 0 games" in result.output
+        assert conn.execute("SELECT COUNT(*) FROM positions").fetchone()[0] == count
+        conn.close()
+
+
+def test_index_positions_skips_non_standard_variants():
+    """Test that games of other variants than standard chess aren't indexed"""
+    pytest.importorskip("chess")
+    runner = CliRunner()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test_games.db")
+        empty_folder = os.path.join(tmpdir, "empty")
+        os.mkdir(empty_folder)
+
+        result = runner.invoke(cli, ["-o", db_path, "save", empty_folder])
+        assert result.exit_code == 0
+
+        conn = sqlite3.connect(db_path)
+        conn.execute(
+            "INSERT INTO games(variant, moves) VALUES ('Chess960', '1. e4 e5 1-0');"
+        )
+        conn.commit()
+
+        result = runner.invoke(
+            cli, ["-o", db_path, "save", empty_folder, "--index-positions"]
+        )
+        assert result.exit_code == 0
+        assert "Indexed positions of 0 games" in result.output
+        assert conn.execute("SELECT COUNT(*) FROM positions").fetchone()[0] == 0
+        conn.close()
+
+
+def test_replay_game_positions():
+    """Test that a game is replayed into one position per ply"""
+    pytest.importorskip("chess")
+
+    positions = replay_game_positions((7, "1. e4 e5 2. Nf3 1-0"))
+
+    assert [(game_id, ply) for game_id, ply, _ in positions] == [
+        (7, 0),
+        (7, 1),
+        (7, 2),
+        (7, 3),
+    ]
+
+
+def test_replay_game_positions_without_moves():
+    """Test that a game without moves has no positions"""
+    pytest.importorskip("chess")
+
+    assert replay_game_positions((1, "")) == []
+    assert replay_game_positions((1, None)) == []
+
+
+def test_replay_game_positions_with_illegal_moves():
+    """Test that games with illegal moves have no positions, not a partial replay"""
+    pytest.importorskip("chess")
+
+    # Moves of a game started from a custom position can't be replayed
+    assert replay_game_positions((1, "1. e4 e5 2. Ke3 Nc6 1-0")) == []